@@ -1,16 +1,33 @@
-from flask import Flask
+from quart import Quart
 from app.config import load_configurations, configure_logging
 from .views import webhook_blueprint
+from .utils.whatsapp_utils import (
+    init_whatsapp,
+    load_semantic_cache_model,
+    close_http_client,
+    start_message_workers,
+    stop_message_workers,
+)
 
 
 def create_app():
-    app = Flask(__name__)
+    # Quart is the asyncio implementation of the Flask API, so the webhook can await
+    # the AI provider and the Graph API instead of blocking a worker per message.
+    app = Quart(__name__)
 
     # Load configurations and logging settings
     load_configurations(app)
     configure_logging()
+    init_whatsapp(app)
 
     # Import and register blueprints, if any
     app.register_blueprint(webhook_blueprint)
 
+    # Incoming messages are answered by background workers, which need the Graph API client
+    # until they stop. The client is shared across requests, so it is closed once on shutdown.
+    app.before_serving(load_semantic_cache_model)
+    app.before_serving(start_message_workers)
+    app.after_serving(stop_message_workers)
+    app.after_serving(close_http_client)
+
     return app
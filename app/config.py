@@ -1,7 +1,10 @@
 import sys
 import os
+import queue
+import atexit
 from dotenv import load_dotenv
 import logging
+from logging.handlers import QueueHandler, QueueListener
 
 
 def load_configurations(app):
@@ -17,8 +20,19 @@ def load_configurations(app):
 
 
 def configure_logging():
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        stream=sys.stdout,
-    )
+    # Records are still formatted on the logging thread (QueueHandler.prepare), but only put on a
+    # queue there; a background thread writes them to stdout, so a slow stdout never blocks the
+    # event loop.
+    root = logging.getLogger()
+    if any(isinstance(handler, QueueHandler) for handler in root.handlers):
+        return
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+
+    root.setLevel(logging.INFO)
+    root.addHandler(QueueHandler(log_queue))
+    listener.start()
+    atexit.register(listener.stop) # Writes out any records still queued
@@ -1,16 +1,23 @@
 import os
 import sys # Added for path modification
 import logging
+import time
+import atexit
+import asyncio
+import datetime
 import google.generativeai as genai
+from google.generativeai import caching
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
-import shelve
 
 # Handle relative imports when running directly
 try:
     from app.utils.file_parser import load_knowledge_from_directory, load_and_extract_text # Added load_and_extract_text for prompt file
+    from app.utils.thread_store import ThreadStore, trim_history
 except ModuleNotFoundError:
     sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
     from app.utils.file_parser import load_knowledge_from_directory, load_and_extract_text # Added load_and_extract_text
+    from app.utils.thread_store import ThreadStore, trim_history
 
 load_dotenv()
 
@@ -18,7 +25,18 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_ASSISTANT_INSTRUCTIONS_BASE = os.getenv("GEMINI_ASSISTANT_INSTRUCTIONS") # Fallback string instructions
 GEMINI_SYSTEM_PROMPT_FILE_PATH = os.getenv("GEMINI_SYSTEM_PROMPT_FILE_PATH") # Path to prompt file
 GEMINI_KNOWLEDGE_BASE_DIR_PATH = os.getenv("GEMINI_KNOWLEDGE_BASE_PATH") # Renamed for clarity
-GEMINI_THREADS_DB = "gemini_threads_db"
+GEMINI_THREADS_TABLE = "gemini_turns" # Table in the shared threads database
+GEMINI_LEGACY_THREADS_DB = "gemini_threads_db" # Shelve used before the threads database, imported once
+GEMINI_MODEL_NAME = 'models/gemini-2.0-flash-lite'
+GEMINI_CACHED_MODEL_NAME = 'models/gemini-2.0-flash-lite-001' # Context caches need a pinned model version
+# The system instructions (with the knowledge base) are cached server-side once they are long enough
+# for Gemini to accept a context cache (about 4096 tokens), so their prefill is reused for every message.
+GEMINI_CONTEXT_CACHE_MIN_CHARS = 16000
+GEMINI_CONTEXT_CACHE_TTL = datetime.timedelta(hours=1)
+GEMINI_CONTEXT_CACHE_RETRY_SECONDS = 60 # Wait before retrying a failed TTL extension of a cache that still exists
+
+# Opened once for the lifetime of the process; see ThreadStore for caching and flushing.
+_threads = ThreadStore(GEMINI_THREADS_TABLE)
 
 # --- Load System Instructions from File or Fallback ---
 system_instructions_from_file = ""
@@ -58,15 +76,48 @@ else:
     except Exception as e:
         logging.error(f"Failed to configure Gemini API: {e}")
 
+def _create_context_cache():
+    """Caches the system instructions in Gemini, returning the CachedContent or None."""
+    try:
+        cache = caching.CachedContent.create(
+            model=GEMINI_CACHED_MODEL_NAME,
+            display_name="whatsapp-bot-system-instructions",
+            system_instruction=final_system_instructions,
+            ttl=GEMINI_CONTEXT_CACHE_TTL,
+        )
+    except Exception as e:
+        logging.warning(f"Failed to create Gemini context cache, sending the system instructions with every request: {e}")
+        return None
+    logging.info(f"Created Gemini context cache {cache.name} for the system instructions.")
+    return cache
+
 # For simplicity, using a global model instance. Consider implications for concurrent requests.
 # You might want to initialize the model inside the function if that's more appropriate for your setup.
 model = None
+context_cache = None
+_context_cache_refresh_at = 0.0 # time.monotonic() after which the cache TTL is extended again
+
+@atexit.register
+def _delete_context_cache():
+    """Deletes the current context cache, so it isn't billed until it expires once this process is gone."""
+    if context_cache is not None:
+        try:
+            context_cache.delete()
+        except Exception as e:
+            logging.warning(f"Failed to delete Gemini context cache {context_cache.name}: {e}")
+
 if GEMINI_API_KEY:
     try:
-        model = genai.GenerativeModel(
-            model_name='models/gemini-2.0-flash-lite',
-            system_instruction=final_system_instructions if final_system_instructions else None
-            )
+        if final_system_instructions and len(final_system_instructions) >= GEMINI_CONTEXT_CACHE_MIN_CHARS:
+            context_cache = _create_context_cache()
+        if context_cache:
+            model = genai.GenerativeModel.from_cached_content(cached_content=context_cache)
+            _context_cache_refresh_at = time.monotonic() + GEMINI_CONTEXT_CACHE_TTL.total_seconds() / 2
+        else:
+            model = genai.GenerativeModel(
+                model_name=GEMINI_MODEL_NAME,
+                system_instruction=final_system_instructions if final_system_instructions else None
+                )
         if final_system_instructions:
             logging.info(f"Gemini model initialized with effective system instructions (len: {len(final_system_instructions)}). Preview: {final_system_instructions[:200]}...")
         else:
@@ -75,58 +126,186 @@ if GEMINI_API_KEY:
     except Exception as e:
         logging.error(f"Failed to initialize Gemini model: {e}")
 
-# --- Thread Management Functions ---
-def check_if_gemini_thread_exists(wa_id: str):
-    """Retrieves conversation history for a given wa_id from shelve."""
-    with shelve.open(GEMINI_THREADS_DB) as S_DB:
-        return S_DB.get(wa_id, None)
+async def _keep_context_cache_alive():
+    """
+    Extends the context cache's TTL once half of it has passed, so it doesn't expire while in use.
+    If it has expired anyway (e.g. the bot was idle), a new cache and model are created; if it
+    still exists, the extension is retried later rather than paying for a second cache.
+    """
+    global _context_cache_refresh_at, context_cache, model
+    if context_cache is None or time.monotonic() < _context_cache_refresh_at:
+        return
+    _context_cache_refresh_at = time.monotonic() + GEMINI_CONTEXT_CACHE_TTL.total_seconds() / 2
+    try:
+        await asyncio.to_thread(context_cache.update, ttl=GEMINI_CONTEXT_CACHE_TTL)
+        return
+    except Exception as e:
+        logging.warning(f"Failed to extend Gemini context cache {context_cache.name}: {e}")
+    try:
+        await asyncio.to_thread(caching.CachedContent.get, context_cache.name)
+        _context_cache_refresh_at = time.monotonic() + GEMINI_CONTEXT_CACHE_RETRY_SECONDS
+        return
+    except google_exceptions.NotFound:
+        logging.info(f"Gemini context cache {context_cache.name} has expired, creating a new one.")
+    except Exception as e:
+        # Can't tell whether it's gone; replacing it could leave two caches billed, so retry later.
+        logging.warning(f"Failed to look up Gemini context cache {context_cache.name}: {e}")
+        _context_cache_refresh_at = time.monotonic() + GEMINI_CONTEXT_CACHE_RETRY_SECONDS
+        return
+    new_cache = await asyncio.to_thread(_create_context_cache)
+    if new_cache:
+        context_cache = new_cache
+        model = genai.GenerativeModel.from_cached_content(cached_content=new_cache)
+    else:
+        context_cache = None
+        model = genai.GenerativeModel(model_name=GEMINI_MODEL_NAME, system_instruction=final_system_instructions)
 
+# --- Thread Management Functions ---
 def store_gemini_thread(wa_id: str, history):
-    """Stores conversation history for a given wa_id into shelve."""
-    with shelve.open(GEMINI_THREADS_DB, writeback=True) as S_DB:
-        S_DB[wa_id] = history
+    """Replaces the conversation history (Gemini Content objects or dicts) for a given wa_id in the thread store."""
+    _threads.set(wa_id, [_content_to_message(content) for content in history])
+
+def last_gemini_reply(wa_id: str) -> str:
+    """Returns the text of the last model turn in the conversation with wa_id, or "" if there is none."""
+    for message in reversed(_threads.get(wa_id, [])):
+        if message["role"] == "model":
+            return message["content"]
+    return ""
+
+def append_gemini_turns(wa_id: str, new_contents):
+    """Appends the Gemini Content objects of a new turn to the history for a given wa_id."""
+    _threads.append(wa_id, [_content_to_message(content) for content in new_contents])
+
+def _to_gemini_history(messages: list) -> list:
+    """Converts role/content messages into Gemini chat history dicts."""
+    history = []
+    summary = None
+    for message in messages:
+        if message["role"] == "system":
+            # Gemini history only has user/model turns, so a summary of earlier turns
+            # is carried as an extra part of the next user turn.
+            summary = message["content"]
+            continue
+        parts = [message["content"]]
+        if summary and message["role"] == "user":
+            parts.insert(0, summary)
+            summary = None
+        history.append({"role": message["role"], "parts": parts})
+    return history
+
+def _content_to_message(content) -> dict:
+    """Flattens a Gemini Content (or equivalent dict) into a role/content message."""
+    if isinstance(content, dict):
+        return {"role": content["role"], "content": "".join(str(part) for part in content["parts"])}
+    return {"role": content.role, "content": "".join(part.text for part in content.parts if part.text)}
+
+# Conversations from before the thread store were kept in a shelve of Gemini Content lists.
+_threads.import_shelve(GEMINI_LEGACY_THREADS_DB, lambda history: [_content_to_message(content) for content in history])
 # --- End Thread Management Functions ---
 
-def generate_ai_response(prompt: str, wa_id: str, name: str) -> str:
+async def generate_ai_response(prompt: str, wa_id: str, name: str) -> str:
     """
     Generates a response from the Google Gemini API, maintaining conversation history.
     """
+    return "".join([chunk async for chunk in generate_ai_response_stream(prompt, wa_id, name)])
+
+async def generate_ai_response_stream(prompt: str, wa_id: str, name: str):
+    """
+    Like generate_ai_response, but yields the response text in pieces as Gemini generates it.
+
+    The turn is only saved to the conversation history once the whole response has arrived.
+    On failure an error message is yielded instead (possibly after some partial text).
+    """
     if not GEMINI_API_KEY:
         logging.error("Gemini API key not configured.")
-        return "Error: Gemini API key not configured."
+        yield "Error: Gemini API key not configured."
+        return
     if not model:
         logging.error("Gemini model not initialized.")
-        return "Error: Gemini model not initialized."
+        yield "Error: Gemini model not initialized."
+        return
 
     logging.info(f"Received message from {name} ({wa_id}): {prompt}")
 
     try:
-        # Retrieve existing conversation history
-        existing_history = check_if_gemini_thread_exists(wa_id)
+        await _keep_context_cache_alive()
+
+        # Retrieve existing conversation history, bounded to the recent turns plus a summary of older ones
+        existing_history = _to_gemini_history(trim_history(_threads.get(wa_id, [])))
         
         # Start a chat session. If history exists, it's loaded. Otherwise, a new chat starts.
         # Gemini's chat.history will automatically be a list of genai.types.Content objects
-        chat = model.start_chat(history=existing_history or [])
+        chat = model.start_chat(history=existing_history)
         
-        response = chat.send_message(prompt)
+        response = await chat.send_message_async(prompt, stream=True)
+        response_parts = []
+        async for chunk in response:
+            if chunk.candidates and chunk.candidates[0].content.parts:
+                text = chunk.candidates[0].content.parts[0].text
+                if text:
+                    response_parts.append(text)
+                    yield text
 
-        # Store the updated history (which now includes the user's prompt and AI's response)
-        store_gemini_thread(wa_id, chat.history)
-
-        if response.candidates and response.candidates[0].content.parts:
-            response_text = response.candidates[0].content.parts[0].text
-            logging.info(f"Gemini response for {name} ({wa_id}): {response_text}")
-            return response_text
-        else:
+        if not response_parts:
             logging.warning(f"Unexpected Gemini API response structure for {name} ({wa_id}): {response}")
-            return "Sorry, I couldn't process that response from Gemini."
+            yield "Sorry, I couldn't process that response from Gemini."
+            return
+
+        # Persist only the user's prompt and the AI's response; earlier turns are already stored.
+        append_gemini_turns(wa_id, chat.history[-2:])
+        logging.info(f"Gemini response for {name} ({wa_id}): {''.join(response_parts)}")
+        if context_cache is not None and response.usage_metadata:
+            usage = response.usage_metadata
+            logging.info(f"Gemini context cache: {usage.cached_content_token_count} of {usage.prompt_token_count} prompt tokens cached")
     except Exception as e:
         logging.error(f"Error generating response from Gemini for {name} ({wa_id}): {e}")
         # It might be good to clear the history for this user if it's corrupted,
         # or handle specific errors like quota issues differently.
         # For now, just return a generic error.
         # store_gemini_thread(wa_id, []) # Optionally clear history on error
-        return f"Error communicating with Gemini: {e}"
+        yield f"Error communicating with Gemini: {e}"
+
+async def _run_examples():
+    # All examples share one event loop: the SDK's async client is bound to the loop it first ran on.
+    test_wa_id = "test_user_123"
+    test_name = "Test User"
+
+    print(f"--- Test 1: First message for {test_name} ---")
+    prompt1 = "Hello Gemini, what's the capital of France?"
+    response1 = await generate_ai_response(prompt1, test_wa_id, test_name)
+    print(f"Prompt: {prompt1}")
+    print(f"Response: {response1}")
+
+    print(f"\n--- Test 2: Follow-up message for {test_name} (should have context) ---")
+    prompt2 = "And what is its population?"
+    response2 = await generate_ai_response(prompt2, test_wa_id, test_name)
+    print(f"Prompt: {prompt2}")
+    print(f"Response: {response2}")
+    
+    print(f"\n--- Test 3: Clearing history for {test_name} (simulating new session) ---")
+    store_gemini_thread(test_wa_id, []) # Clear history
+    prompt3 = "What is its population?" # Same as prompt2, but context should be lost
+    response3 = await generate_ai_response(prompt3, test_wa_id, test_name)
+    print(f"Prompt: {prompt3}")
+    print(f"Response: {response3}")
+
+    # Clean up the test database entry
+    _threads.delete(test_wa_id)
+    print(f"\nCleaned up test data for {test_wa_id}.")
+
+    print("Listing available Gemini models...")
+    try:
+        for m in genai.list_models():
+            # Check if 'generateContent' is a supported method for the model
+            if 'generateContent' in m.supported_generation_methods:
+                print(f"Model name: {m.name} - Display name: {m.display_name}")
+    except Exception as e:
+        print(f"Could not list models: {e}")
+
+    test_prompt = "Hello, Gemini! How are you today?"
+    print(f"Sending prompt to Gemini: {test_prompt}")
+    response = await generate_ai_response(test_prompt, "test_user_123", "Test User")
+    print(f"Gemini response: {response}")
 
 if __name__ == '__main__':
     # Example usage (for testing purposes)
@@ -134,48 +313,4 @@ if __name__ == '__main__':
     if not (GEMINI_API_KEY and model):
         print("Gemini API key not set or model not initialized. Skipping example usage.")
     else:
-        test_wa_id = "test_user_123"
-        test_name = "Test User"
-
-        print(f"--- Test 1: First message for {test_name} ---")
-        prompt1 = "Hello Gemini, what's the capital of France?"
-        response1 = generate_ai_response(prompt1, test_wa_id, test_name)
-        print(f"Prompt: {prompt1}")
-        print(f"Response: {response1}")
-
-        print(f"\n--- Test 2: Follow-up message for {test_name} (should have context) ---")
-        prompt2 = "And what is its population?"
-        response2 = generate_ai_response(prompt2, test_wa_id, test_name)
-        print(f"Prompt: {prompt2}")
-        print(f"Response: {response2}")
-        
-        print(f"\n--- Test 3: Clearing history for {test_name} (simulating new session) ---")
-        store_gemini_thread(test_wa_id, []) # Clear history
-        prompt3 = "What is its population?" # Same as prompt2, but context should be lost
-        response3 = generate_ai_response(prompt3, test_wa_id, test_name)
-        print(f"Prompt: {prompt3}")
-        print(f"Response: {response3}")
-
-        # Clean up the test database entry
-        with shelve.open(GEMINI_THREADS_DB) as S_DB:
-            if test_wa_id in S_DB:
-                del S_DB[test_wa_id]
-        print(f"\nCleaned up test data for {test_wa_id}.")
-
-    if GEMINI_API_KEY:
-        print("Listing available Gemini models...")
-        try:
-            for m in genai.list_models():
-                # Check if 'generateContent' is a supported method for the model
-                if 'generateContent' in m.supported_generation_methods:
-                    print(f"Model name: {m.name} - Display name: {m.display_name}")
-        except Exception as e:
-            print(f"Could not list models: {e}")
-
-    if GEMINI_API_KEY and model:
-        test_prompt = "Hello, Gemini! How are you today?"
-        print(f"Sending prompt to Gemini: {test_prompt}")
-        response = generate_ai_response(test_prompt, "test_user_123", "Test User")
-        print(f"Gemini response: {response}")
-    else:
-        print("Gemini API key not set or model not initialized. Skipping example usage.") 
\ No newline at end of file
+        asyncio.run(_run_examples())
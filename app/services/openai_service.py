@@ -39,7 +39,7 @@ def check_if_thread_exists(wa_id):
 
 
 def store_thread(wa_id, thread_id):
-    with shelve.open("threads_db", writeback=True) as threads_shelf:
+    with shelve.open("threads_db") as threads_shelf:
         threads_shelf[wa_id] = thread_id
 
 
@@ -1,53 +1,147 @@
-import fitz  # PyMuPDF
-import docx
-# import pandas as pd # Commented out direct import
+import io
 import os
+import json
+import mmap
 import logging
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
 
-# Try to import pandas for Excel support, but don't make it a hard requirement
-try:
-    import pandas as pd
-    PANDAS_AVAILABLE = True
-except ImportError:
-    PANDAS_AVAILABLE = False
-    pd = None # Ensure pd is defined even if not available
-    logging.warning("Pandas library not found. Excel file (.xlsx, .xls) processing will be skipped.")
-
-# Adjusted SUPPORTED_EXTENSIONS based on PANDAS_AVAILABLE
-SUPPORTED_EXTENSIONS = [".pdf", ".docx", ".txt"]
-if PANDAS_AVAILABLE:
-    SUPPORTED_EXTENSIONS.extend([".xlsx", ".xls"])
-
-def extract_text_from_pdf(file_path: str) -> str:
-    """Extracts text content from a PDF file."""
-    doc = fitz.open(file_path)
-    text = ""
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        text += page.get_text()
-    doc.close()
-    return text
+# The parsers (PyMuPDF, python-docx, pandas) are imported inside the extractor that needs them,
+# so importing this module (e.g. just to read a .txt system prompt) doesn't pay for loading
+# pandas and friends. pandas remains optional: Excel files are skipped if it isn't installed.
+SUPPORTED_EXTENSIONS = frozenset([".pdf", ".docx", ".txt", ".xlsx", ".xls"])
+
+# Paths in .env are relative to the project root; file_parser.py lives in app/utils/.
+_PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+# Extracted text is cached next to the source files, keyed by path, size and mtime,
+# so unchanged knowledge base files are not re-parsed on every startup.
+KB_CACHE_DIR_NAME = ".kb_cache"
+# Maps a hash of the directory listing (names, sizes, mtimes) to the cached consolidated text.
+KB_MANIFEST_NAME = "kb_manifest.json"
+
+load_dotenv()
+
+def _parse_pdf_max_pages() -> int:
+    """Reads KB_PDF_MAX_PAGES (0 or unset means every page), falling back to 0 if it is invalid."""
+    value = os.getenv("KB_PDF_MAX_PAGES") or "0"
+    try:
+        max_pages = int(value)
+    except ValueError:
+        max_pages = -1
+    if max_pages < 0:
+        logging.warning(f"Ignoring invalid KB_PDF_MAX_PAGES={value!r}, extracting every PDF page.")
+        return 0
+    return max_pages
+
+# Only the first KB_PDF_MAX_PAGES pages of each PDF are extracted, if set.
+KB_PDF_MAX_PAGES = _parse_pdf_max_pages()
+
+def _cache_key(*parts) -> str:
+    """Builds a cache key from the given parts (e.g. path, size and mtime)."""
+    return hashlib.sha256("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()[:32]
+
+def _read_cache(cache_dir: str, key: str):
+    """Returns the cached text for key, or None if it is not cached."""
+    try:
+        with open(os.path.join(cache_dir, key + ".txt"), "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def _write_cache(cache_dir: str, key: str, text: str):
+    """Stores text under key. Failures are logged and otherwise ignored."""
+    try:
+        _write_atomic(cache_dir, key + ".txt", text)
+    except OSError as e:
+        logging.warning(f"Could not write knowledge base cache in {cache_dir}: {e}")
+
+def _write_atomic(cache_dir: str, name: str, text: str):
+    """Writes text to cache_dir/name via a temporary file, so concurrent readers never see a partial file."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def _read_directory_cache(cache_dir: str, listing_key: str):
+    """Returns the consolidated text the manifest records for listing_key, or None."""
+    try:
+        with open(os.path.join(cache_dir, KB_MANIFEST_NAME), "r", encoding="utf-8") as f:
+            cached_name = json.load(f).get(listing_key)
+        if not cached_name:
+            return None
+        # Map the file instead of reading it through a buffered stream; it is decoded in one go.
+        with open(os.path.join(cache_dir, cached_name), "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped[:].decode("utf-8")
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e: # ValueError covers a corrupt manifest or an empty file
+        logging.warning(f"Ignoring unreadable knowledge base cache in {cache_dir}: {e}")
+        return None
+
+def _write_directory_cache(cache_dir: str, listing_key: str, text: str):
+    """Stores the consolidated text and points the manifest at it, removing the previous entry's file."""
+    cached_name = f"directory-{listing_key[:32]}.txt"
+    manifest_path = os.path.join(cache_dir, KB_MANIFEST_NAME)
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            stale_names = [name for name in json.load(f).values() if name != cached_name]
+    except (OSError, ValueError):
+        stale_names = []
+    try:
+        _write_atomic(cache_dir, cached_name, text)
+        _write_atomic(cache_dir, KB_MANIFEST_NAME, json.dumps({listing_key: cached_name}))
+        for name in stale_names:
+            os.remove(os.path.join(cache_dir, name))
+    except OSError as e:
+        logging.warning(f"Could not update knowledge base manifest in {cache_dir}: {e}")
+
+def extract_text_from_pdf(file_path: str, max_pages: int = None) -> str:
+    """Extracts text content from a PDF file, optionally from the first max_pages pages only."""
+    import fitz  # PyMuPDF
+
+    parts = []
+    with fitz.open(file_path) as doc:
+        for page_num, page in enumerate(doc):
+            if max_pages and page_num >= max_pages:
+                break
+            # Plain text blocks are all the knowledge base needs; sort=False skips the reading-order sort pass.
+            blocks = page.get_text("blocks", sort=False)
+            if not blocks:
+                continue # Image-only (scanned) page without a text layer
+            parts.extend(block[4] for block in blocks if block[6] == 0) # block_type 0 is text, 1 is image
+    return "".join(parts)
 
 def extract_text_from_docx(file_path: str) -> str:
     """Extracts text content from a .docx Word file."""
+    import docx
+
     doc = docx.Document(file_path)
     text = "\n".join([paragraph.text for paragraph in doc.paragraphs])
     return text
 
 def extract_text_from_excel(file_path: str) -> str:
     """Extracts text content from an Excel file (.xlsx, .xls).
-       Converts each sheet to a CSV-like string representation.
+       Converts each sheet to a CSV string representation.
        Requires pandas to be installed."""
-    if not PANDAS_AVAILABLE:
+    try:
+        import pandas as pd
+    except ImportError:
         logging.warning(f"Skipping Excel file {file_path} as pandas library is not available.")
         return ""
     
-    xls = pd.ExcelFile(file_path)
-    text = ""
-    for sheet_name in xls.sheet_names:
-        df = xls.parse(sheet_name)
-        text += f"Sheet: {sheet_name}\n{df.to_string(index=False)}\n\n"
-    return text.strip()
+    # One read_excel call parses every sheet from a single open workbook; to_csv is
+    # written in C and skips the column padding to_string does.
+    buf = io.StringIO()
+    for sheet_name, df in pd.read_excel(file_path, sheet_name=None).items():
+        buf.write(f"Sheet: {sheet_name}\n")
+        df.to_csv(buf, index=False)
+        buf.write("\n")
+    return buf.getvalue().strip()
 
 def extract_text_from_txt(file_path: str) -> str:
     """Extracts text content from a .txt file."""
@@ -64,21 +158,27 @@ def load_and_extract_text(file_path: str) -> str:
         # Ensure the path is absolute or correctly relative to the project root.
         # This logic might need adjustment based on your execution context (e.g., where run.py is)
         if not os.path.isabs(file_path):
-            # This assumes file_parser.py is in app/utils/ and services are in app/services/
-            # and the paths in .env are relative to the project root.
-            project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
-            file_path = os.path.join(project_root, file_path)
+            file_path = os.path.join(_PROJECT_ROOT, file_path)
 
-        if not os.path.exists(file_path):
-            logging.warning(f"Knowledge base file not found at: {file_path}")
-            return ""
+        # A missing file surfaces as FileNotFoundError from the stat/open below.
+        extension = "." + file_path.rpartition(".")[2].lower()
 
-        _, extension = os.path.splitext(file_path.lower())
+        # Plain text is as cheap to read as the cache itself, so only parsed formats are cached.
+        pdf_max_pages = KB_PDF_MAX_PAGES if extension == ".pdf" else 0
+        cache_dir = cache_key = None
+        if extension != ".txt":
+            st = os.stat(file_path)
+            cache_dir = os.path.join(os.path.dirname(file_path), KB_CACHE_DIR_NAME)
+            cache_key = _cache_key(file_path, st.st_size, st.st_mtime_ns, pdf_max_pages)
+            content = _read_cache(cache_dir, cache_key)
+            if content is not None:
+                logging.info(f"Loaded cached text for {file_path} ({len(content)} chars).")
+                return content
 
         logging.info(f"Attempting to load and extract text from: {file_path} (extension: {extension})")
 
         if extension == ".pdf":
-            content = extract_text_from_pdf(file_path)
+            content = extract_text_from_pdf(file_path, pdf_max_pages)
         elif extension == ".docx":
             content = extract_text_from_docx(file_path)
         elif extension == ".xlsx" or extension == ".xls":
@@ -86,12 +186,17 @@ def load_and_extract_text(file_path: str) -> str:
         elif extension == ".txt":
             content = extract_text_from_txt(file_path)
         else:
-            logging.warning(f"Unsupported file type: {extension} for file {file_path}. Only {SUPPORTED_EXTENSIONS} are supported.")
+            logging.warning(f"Unsupported file type: {extension} for file {file_path}. Only {sorted(SUPPORTED_EXTENSIONS)} are supported.")
             return ""
         
         logging.info(f"Successfully extracted text from {file_path} ({len(content)} chars).")
+        if cache_key and content:
+            _write_cache(cache_dir, cache_key, content)
         return content
 
+    except FileNotFoundError:
+        logging.warning(f"Knowledge base file not found at: {file_path}")
+        return ""
     except Exception as e:
         logging.error(f"Error loading or parsing file {file_path}: {e}")
         return ""
@@ -103,44 +208,80 @@ def load_knowledge_from_directory(directory_path: str) -> str:
         return ""
 
     # Resolve directory path relative to project root if necessary
-    # This logic assumes file_parser.py is in app/utils/
-    # and the paths in .env are relative to the project root.
     if not os.path.isabs(directory_path):
-        project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
-        directory_path = os.path.join(project_root, directory_path)
+        directory_path = os.path.join(_PROJECT_ROOT, directory_path)
 
     if not os.path.isdir(directory_path):
         logging.warning(f"Knowledge base directory not found or is not a directory: {directory_path}")
         return ""
 
-    all_text_content = []
     logging.info(f"Scanning directory for knowledge base files: {directory_path}")
 
-    for filename in sorted(os.listdir(directory_path)): # Sort for consistent order
-        file_path = os.path.join(directory_path, filename)
-        if os.path.isfile(file_path):
-            _, extension = os.path.splitext(filename.lower())
-            if extension in SUPPORTED_EXTENSIONS:
-                logging.info(f"Found supported file in directory: {filename}")
-                # Use the existing load_and_extract_text to get content from this individual file
-                # Note: load_and_extract_text already handles relative path resolution if called with a relative path
-                # but here file_path is already absolute or correctly resolved relative to directory_path
-                text = load_and_extract_text(file_path) 
-                if text:
-                    # Add a separator or filename marker for clarity if desired
-                    all_text_content.append(f"--- Content from: {filename} ---\n{text}\n\n")
-            else:
-                logging.debug(f"Skipping unsupported file in directory: {filename}")
-    
-    if not all_text_content:
+    supported_files = []
+    # scandir's entries carry the file type from the directory listing, so only supported files get stat'ed.
+    with os.scandir(directory_path) as it:
+        entries = sorted((entry for entry in it if entry.is_file()), key=lambda entry: entry.name) # Sort for consistent order
+    for entry in entries:
+        extension = "." + entry.name.rpartition(".")[2].lower()
+        if extension in SUPPORTED_EXTENSIONS:
+            logging.info(f"Found supported file in directory: {entry.name}")
+            supported_files.append((entry.name, entry.path, entry.stat()))
+        else:
+            logging.debug(f"Skipping unsupported file in directory: {entry.name}")
+
+    if not supported_files:
+        logging.info(f"No supported files found or no content extracted from directory: {directory_path}")
+        return ""
+
+    # If no file was added, removed or modified (and the PDF page limit is unchanged), reuse the
+    # previously consolidated text as a whole.
+    cache_dir = os.path.join(directory_path, KB_CACHE_DIR_NAME)
+    listing = "|".join(f"{filename}:{st.st_size}:{st.st_mtime_ns}" for filename, _, st in supported_files)
+    listing_key = hashlib.sha256(f"{listing}|pdf_max_pages={KB_PDF_MAX_PAGES}".encode("utf-8")).hexdigest()
+    cached_content = _read_directory_cache(cache_dir, listing_key)
+    if cached_content is not None:
+        logging.info(f"Loaded cached knowledge for directory {directory_path} ({len(cached_content)} chars).")
+        return cached_content
+
+    # PyMuPDF doesn't support multithreading, so PDFs are parsed one at a time on this thread, as the
+    # sorted output reaches them, while the other formats (mostly file I/O) are parsed in worker threads.
+    # Note: file_path is already absolute or correctly resolved relative to directory_path
+    # Each file's text is written straight into one buffer and released, rather than keeping
+    # a header-prefixed copy of every file around until a final join.
+    all_text_content = io.StringIO()
+    files_with_content = 0
+    with ThreadPoolExecutor(max_workers=min(8, len(supported_files))) as executor:
+        futures = {
+            file_path: executor.submit(load_and_extract_text, file_path)
+            for _, file_path, _ in supported_files
+            if not file_path.lower().endswith(".pdf")
+        }
+        for filename, file_path, _ in supported_files:
+            text = futures.pop(file_path).result() if file_path in futures else load_and_extract_text(file_path)
+            if text:
+                # Add a separator or filename marker for clarity if desired
+                all_text_content.write("--- Content from: ")
+                all_text_content.write(filename)
+                all_text_content.write(" ---\n")
+                all_text_content.write(text)
+                all_text_content.write("\n\n")
+                files_with_content += 1
+            del text
+
+    if not files_with_content:
         logging.info(f"No supported files found or no content extracted from directory: {directory_path}")
         return ""
     
-    concatenated_content = "".join(all_text_content)
-    logging.info(f"Consolidated knowledge from directory {directory_path} ({len(concatenated_content)} chars from {len(all_text_content)} files).")
+    concatenated_content = all_text_content.getvalue()
+    all_text_content.close()
+    logging.info(f"Consolidated knowledge from directory {directory_path} ({len(concatenated_content)} chars from {files_with_content} files).")
+    # Don't pin a partial result: a file may have failed only because its parser isn't installed yet.
+    if files_with_content == len(supported_files):
+        _write_directory_cache(cache_dir, listing_key, concatenated_content)
     return concatenated_content
 
 if __name__ == '__main__':
+    import docx
     # Create dummy files for testing in a temporary 'test_data' directory
     # This assumes you run: python app/utils/file_parser.py from the project root.
     test_data_dir = "test_data_parser"
@@ -158,7 +299,11 @@ if __name__ == '__main__':
     doc.add_paragraph("This is a test DOCX file.")
     doc.save(docx_file)
     
-    if PANDAS_AVAILABLE:
+    try:
+        import pandas as pd
+    except ImportError:
+        pd = None
+    if pd is not None:
         df_test = pd.DataFrame({'Col1': [1, 2], 'Col2': ['A', 'B']})
         with pd.ExcelWriter(excel_file, engine='openpyxl') as writer:
             df_test.to_excel(writer, sheet_name='Sheet1', index=False)
@@ -0,0 +1,102 @@
+import logging
+import sqlite3
+import threading
+import time
+
+from app.utils.thread_store import THREADS_DB
+
+# Try to import fastembed (and numpy, which it depends on) for the semantic cache,
+# but don't make it a hard requirement: without it every message goes to the AI provider.
+try:
+    import numpy as np
+    from fastembed import TextEmbedding
+    FASTEMBED_AVAILABLE = True
+except ImportError:
+    FASTEMBED_AVAILABLE = False
+    logging.info("fastembed library not found. The semantic response cache is disabled.")
+
+SEMANTIC_CACHE_TABLE = "semantic_cache"
+SEMANTIC_CACHE_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+SEMANTIC_CACHE_THRESHOLD = 0.92 # Minimum cosine similarity for a cached reply to be reused
+SEMANTIC_CACHE_TTL = 3600 # Seconds a cached reply stays valid
+
+
+class SemanticCache:
+    """
+    Per-user cache of AI replies keyed by the embedding of the user's message.
+
+    A message whose embedding is close enough (cosine similarity >= threshold) to one the
+    same wa_id sent within the TTL, at the same point in the conversation (the same context,
+    e.g. a hash of the previous reply), gets the stored reply back without calling the AI
+    provider. Entries live in a table of the shared threads database; embeddings are
+    normalized float32 vectors, so similarity is a dot product over that user's rows.
+    The embedding model is loaded on first use.
+    """
+
+    def __init__(self, path: str = THREADS_DB, threshold: float = SEMANTIC_CACHE_THRESHOLD, ttl: float = SEMANTIC_CACHE_TTL):
+        self.enabled = FASTEMBED_AVAILABLE
+        self._threshold = threshold
+        self._ttl = ttl
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        if not self.enabled:
+            return
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        columns = [row[1] for row in self._conn.execute(f"PRAGMA table_info({SEMANTIC_CACHE_TABLE})")]
+        if columns and "context" not in columns:
+            # Entries cached before replies were tied to their context can't be reused safely.
+            self._conn.execute(f"DROP TABLE {SEMANTIC_CACHE_TABLE}")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {SEMANTIC_CACHE_TABLE} ("
+            "wa_id TEXT NOT NULL, context TEXT NOT NULL, embedding BLOB NOT NULL, message TEXT NOT NULL, "
+            "response TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {SEMANTIC_CACHE_TABLE}_wa_id ON {SEMANTIC_CACHE_TABLE} (wa_id, created_at)")
+        self._conn.commit()
+
+    def load_model(self):
+        """Loads (downloading it if needed) the embedding model, if it isn't loaded yet."""
+        with self._model_lock:
+            if self._model is None:
+                logging.info(f"Loading semantic cache embedding model {SEMANTIC_CACHE_MODEL}")
+                self._model = TextEmbedding(model_name=SEMANTIC_CACHE_MODEL)
+
+    def embed(self, message: str):
+        """Returns the normalized embedding of message."""
+        self.load_model()
+        with self._model_lock:
+            embedding = next(iter(self._model.embed([message]))).astype(np.float32)
+        return embedding / (np.linalg.norm(embedding) or 1.0)
+
+    def lookup(self, wa_id: str, context: str, embedding):
+        """Returns the cached reply for the most similar recent message from wa_id in context, or None."""
+        with self._db_lock:
+            rows = self._conn.execute(
+                f"SELECT embedding, response FROM {SEMANTIC_CACHE_TABLE} WHERE wa_id = ? AND context = ? AND created_at >= ?",
+                (wa_id, context, time.time() - self._ttl),
+            ).fetchall()
+        if not rows:
+            return None
+        matrix = np.frombuffer(b"".join(row[0] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+        similarities = matrix @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] < self._threshold:
+            return None
+        logging.info(f"Semantic cache hit for {wa_id} (similarity {similarities[best]:.3f})")
+        return rows[best][1]
+
+    def store(self, wa_id: str, context: str, embedding, message: str, response: str):
+        """Caches response for message in context, and drops this user's expired entries."""
+        now = time.time()
+        with self._db_lock, self._conn:
+            self._conn.execute(
+                f"DELETE FROM {SEMANTIC_CACHE_TABLE} WHERE wa_id = ? AND created_at < ?",
+                (wa_id, now - self._ttl),
+            )
+            self._conn.execute(
+                f"INSERT INTO {SEMANTIC_CACHE_TABLE} (wa_id, context, embedding, message, response, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (wa_id, context, embedding.astype(np.float32).tobytes(), message, response, now),
+            )
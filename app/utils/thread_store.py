@@ -0,0 +1,337 @@
+import atexit
+import dbm
+import logging
+import shelve
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Try to import zstandard to compress long messages, but don't make it a hard requirement
+try:
+    import zstandard as zstd
+    ZSTD_AVAILABLE = True
+    _zstd_compressor = zstd.ZstdCompressor(level=3)
+    _zstd_decompressor = zstd.ZstdDecompressor()
+except ImportError:
+    ZSTD_AVAILABLE = False
+    logging.info("zstandard library not found. Conversation history will be stored uncompressed.")
+
+THREADS_DB = "threads.db"
+
+# Messages at least this long are stored zstd-compressed (as a BLOB); shorter ones would not shrink.
+COMPRESS_MIN_BYTES = 512
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd" # Every zstd frame starts with this
+
+# A batch that fails because the database is busy/locked is retried this many times before its
+# statements are written (or dropped) one by one like any other failed batch.
+FLUSH_BUSY_RETRIES = 5
+
+# Only the most recent turns are sent to the model; older ones are folded into a short summary.
+HISTORY_MAX_TURNS = 8
+HISTORY_SUMMARY_THRESHOLD = 16
+HISTORY_SUMMARY_MAX_CHARS = 1000
+# Messages kept in memory (and loaded from disk) per conversation: enough for the window sent to
+# the model plus the older turns trim_history summarizes. Older messages stay in the database only.
+HISTORY_CACHED_MESSAGES = 2 * (HISTORY_SUMMARY_THRESHOLD + HISTORY_MAX_TURNS)
+
+
+class ThreadStore:
+    """
+    Conversation history store backed by a table of turns in a shared SQLite database.
+
+    Each message is one row (wa_id, idx, role, content), so a new turn is persisted by
+    appending its messages instead of re-serializing the whole history. The database runs
+    in WAL mode with synchronous=NORMAL, which avoids an fsync per commit.
+
+    Recently used conversations are kept in an in-memory LRU in front of the database, each
+    as a deque of its last max_messages messages, so appending is O(1) and old turns fall
+    off automatically. Writes are batched to disk by a background thread on its own
+    connection, which also does the compression, so callers never wait on disk writes.
+    Conversations with unwritten changes are never evicted, so the LRU is always at least as
+    new as the database. Long messages are stored zstd-compressed when zstandard is
+    installed; rows written as plain text stay readable.
+
+    Histories are lists of {"role": ..., "content": ...} dicts. get() returns the most
+    recent max_messages of them as a new list.
+    """
+
+    def __init__(self, table: str, path: str = THREADS_DB, max_cached: int = 1024, max_messages: int = HISTORY_CACHED_MESSAGES, flush_interval: float = 0.1):
+        self._table = table
+        self._max_messages = max_messages
+        self._conn = sqlite3.connect(path, check_same_thread=False)  # Reads, under self._lock
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._write_conn = sqlite3.connect(path, check_same_thread=False)  # Writes, under self._write_lock
+        self._write_conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "wa_id TEXT NOT NULL, idx INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, "
+            "PRIMARY KEY (wa_id, idx))"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS imported_shelves (source TEXT PRIMARY KEY)")
+        self._conn.commit()
+        # Each message's idx is assigned by the database when it is written (one past the highest
+        # stored for that wa_id), so a stale view of the table, e.g. from another process sharing
+        # the file, can't produce conflicting rows.
+        self._insert_sql = (
+            f"INSERT INTO {table} (wa_id, idx, role, content) "
+            f"SELECT ?1, COALESCE(MAX(idx), -1) + 1, ?2, ?3 FROM {table} WHERE wa_id = ?1"
+        )
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._mem = OrderedDict()
+        self._pending = []  # (sql, rows, encode) statements waiting for the next flush, in order
+        self._pending_ids = set()  # wa_ids touched by self._pending
+        self._flushing_ids = set()  # wa_ids touched by the batch being written right now
+        self._busy_retries = 0  # Times the batch at the front of self._pending found the database busy
+        self._max_cached = max_cached
+        self._flush_interval = flush_interval
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._writer = threading.Thread(target=self._flush_loop, name=f"thread-store-{table}", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def get(self, wa_id: str, default=None):
+        """Returns the recent history for wa_id, or default if there is none."""
+        with self._lock:
+            history = list(self._load(wa_id))
+        return history if history else default
+
+    def append(self, wa_id: str, messages: list):
+        """Appends new messages to the history for wa_id, writing only those messages."""
+        rows = [(wa_id, message["role"], message["content"]) for message in messages]
+        if not rows:
+            return
+        with self._lock:
+            thread = self._load(wa_id)
+            self._pending.append((self._insert_sql, rows, True))
+            self._pending_ids.add(wa_id)
+            thread.extend(messages)
+        self._wakeup.set()
+
+    def set(self, wa_id: str, history: list):
+        """Replaces the whole stored history for wa_id."""
+        history = list(history)
+        with self._lock:
+            self._pending.append((f"DELETE FROM {self._table} WHERE wa_id = ?", [(wa_id,)], False))
+            if history:
+                self._pending.append((self._insert_sql, [(wa_id, message["role"], message["content"]) for message in history], True))
+            self._pending_ids.add(wa_id)
+            self._remember(wa_id, deque(history, maxlen=self._max_messages))
+        self._wakeup.set()
+
+    def delete(self, wa_id: str):
+        """Removes any stored history for wa_id."""
+        self.set(wa_id, [])
+
+    def import_shelve(self, shelve_path: str, to_messages):
+        """
+        One-time import of the histories in shelve_path, the shelve database conversations were
+        kept in before this store. to_messages converts one stored history into role/content
+        messages. Conversations that already have history here are left alone, and the shelve
+        itself is not modified.
+        """
+        source = f"{self._table}:{shelve_path}"
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM imported_shelves WHERE source = ?", (source,)).fetchone():
+                return
+        try:
+            legacy = shelve.open(shelve_path, flag="r")
+        except dbm.error:
+            return  # No such shelve, nothing to import
+
+        imported = 0
+        with legacy:
+            for wa_id in list(legacy.keys()):
+                try:
+                    messages = to_messages(legacy[wa_id])
+                except Exception as e:
+                    logging.warning(f"Skipping unreadable history for {wa_id} in {shelve_path}: {e}")
+                    continue
+                if messages and self.get(wa_id) is None:
+                    self.set(wa_id, messages)
+                    imported += 1
+        self.flush()
+        with self._write_lock, self._write_conn:
+            self._write_conn.execute("INSERT OR IGNORE INTO imported_shelves (source) VALUES (?)", (source,))
+        logging.info(f"Imported {imported} conversations from {shelve_path} into {self._table}.")
+
+    def flush(self):
+        """Writes all pending changes to the database."""
+        with self._write_lock:
+            # Only take the queued statements under the lock; encoding and writing them happens
+            # without it, so get() and append() don't wait for the disk.
+            with self._lock:
+                pending, self._pending = self._pending, []
+                self._flushing_ids, self._pending_ids = self._pending_ids, set()
+            try:
+                if pending:
+                    self._write(pending)
+                self._busy_retries = 0
+            except sqlite3.Error as e:
+                if _is_busy(e) and self._busy_retries < FLUSH_BUSY_RETRIES:
+                    # Another connection holds the database: put the batch back in front of
+                    # anything queued since, to be retried.
+                    self._busy_retries += 1
+                    with self._lock:
+                        self._pending[:0] = pending
+                        self._pending_ids |= self._flushing_ids
+                        self._flushing_ids = set()
+                    raise
+                # Retrying won't help (e.g. a constraint violation, a read-only or full disk), so
+                # write the statements one by one and drop only the ones that fail, instead of
+                # blocking every later write.
+                self._busy_retries = 0
+                logging.error(f"Failed to write conversation history batch to {self._table}, retrying statement by statement: {e}")
+                for statement in pending:
+                    try:
+                        self._write([statement])
+                    except sqlite3.Error as e:
+                        logging.error(f"Dropping conversation history change for {self._table} that can't be written: {e}")
+            with self._lock:
+                self._flushing_ids = set()
+                self._evict()
+
+    def close(self):
+        """Flushes pending writes and closes the database connection."""
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._writer.join()
+        while True:
+            try:
+                self.flush()
+                break
+            except sqlite3.Error as e:
+                # Only a busy database raises here, and only FLUSH_BUSY_RETRIES times in a row.
+                logging.warning(f"Database busy while closing, retrying: {e}")
+                time.sleep(self._flush_interval)
+        self._conn.close()
+        self._write_conn.close()
+
+    def _load(self, wa_id: str) -> deque:
+        # Caller holds the lock.
+        if wa_id in self._mem:
+            self._mem.move_to_end(wa_id)
+            return self._mem[wa_id]
+        # Not in memory means not evicted with unwritten changes, so the database is up to date.
+        rows = self._conn.execute(
+            f"SELECT role, content FROM {self._table} WHERE wa_id = ? ORDER BY idx DESC LIMIT ?",
+            (wa_id, self._max_messages),
+        ).fetchall()
+        messages = deque(
+            ({"role": role, "content": _decode_content(content)} for role, content in reversed(rows)),
+            maxlen=self._max_messages,
+        )
+        self._remember(wa_id, messages)
+        return messages
+
+    def _remember(self, wa_id: str, messages: deque):
+        # Caller holds the lock.
+        self._mem[wa_id] = messages
+        self._mem.move_to_end(wa_id)
+        # The caller is about to use (and maybe change) this entry, so it must stay cached.
+        self._evict(keep=wa_id)
+
+    def _evict(self, keep: str = None):
+        # Caller holds the lock. Drops least recently used conversations beyond max_cached, except
+        # keep and those with unwritten changes; they are dropped after a later flush instead.
+        excess = len(self._mem) - self._max_cached
+        if excess <= 0:
+            return
+        evictable = []
+        for wa_id in self._mem:
+            if len(evictable) == excess:
+                break
+            if wa_id != keep and wa_id not in self._pending_ids and wa_id not in self._flushing_ids:
+                evictable.append(wa_id)
+        for wa_id in evictable:
+            del self._mem[wa_id]
+
+    def _write(self, pending: list):
+        # Caller holds the write lock.
+        with self._write_conn:
+            for sql, rows, encode in pending:
+                if encode:
+                    rows = [(*row[:-1], _encode_content(row[-1])) for row in rows]
+                self._write_conn.executemany(sql, rows)
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self._closed:
+                break
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Failed to flush conversation history to disk: {e}")
+                # Retry the requeued batch without waiting for another write to come in.
+                self._wakeup.set()
+            # Let further writes accumulate so they go out in a single batch.
+            time.sleep(self._flush_interval)
+
+
+def _is_busy(error: sqlite3.Error) -> bool:
+    """Whether error means another connection held the database, which may pass on retry."""
+    return "locked" in str(error) or "busy" in str(error)
+
+
+def _encode_content(content: str):
+    """Returns content as stored in the database: a compressed BLOB for long messages, else text."""
+    if not ZSTD_AVAILABLE:
+        return content
+    data = content.encode("utf-8")
+    if len(data) < COMPRESS_MIN_BYTES:
+        return content
+    return _zstd_compressor.compress(data)
+
+
+def _decode_content(content) -> str:
+    """Inverse of _encode_content; plain text rows are returned unchanged."""
+    if isinstance(content, str):
+        return content
+    if content[:4] == ZSTD_MAGIC:
+        if not ZSTD_AVAILABLE:
+            raise RuntimeError("Stored message is zstd-compressed but the zstandard library is not installed.")
+        return _zstd_decompressor.decompress(content).decode("utf-8")
+    return content.decode("utf-8")
+
+
+def trim_history(messages: list, max_turns: int = HISTORY_MAX_TURNS, summary_threshold: int = HISTORY_SUMMARY_THRESHOLD) -> list:
+    """
+    Bounds the history sent to the model.
+
+    Once the history holds more than summary_threshold turns (user/assistant pairs), only the
+    last max_turns turns are kept and the earlier ones are replaced by a single system message
+    summarizing them. The summary is extractive (the first sentence of the most recent dropped
+    messages, capped at HISTORY_SUMMARY_MAX_CHARS), so it costs no extra model call.
+    """
+    if len(messages) <= 2 * summary_threshold:
+        return messages
+
+    dropped, kept = messages[: -2 * max_turns], messages[-2 * max_turns:]
+    summary_lines = []
+    budget = HISTORY_SUMMARY_MAX_CHARS
+    for message in reversed(dropped):
+        line = f"{message['role']}: {_first_sentence(message['content'])}"
+        if len(line) > budget:
+            break
+        summary_lines.append(line)
+        budget -= len(line) + 1
+    summary_lines.reverse()
+    return [{"role": "system", "content": "Earlier conversation summary: " + "\n".join(summary_lines)}, *kept]
+
+
+def _first_sentence(text: str, max_chars: int = 200) -> str:
+    """Returns the first sentence (or line) of text, truncated to max_chars."""
+    text = text.strip()
+    end = len(text)
+    for separator in (". ", "? ", "! ", "\n"):
+        index = text.find(separator)
+        if index != -1:
+            end = min(end, index + 1)
+    return text[: min(end, max_chars)].strip()
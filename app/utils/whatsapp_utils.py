@@ -1,16 +1,26 @@
 import logging
-from flask import current_app, jsonify
-import json
-import requests
+import asyncio
+from quart import Response
+import orjson
+import httpx
 import os
+import socket
+import functools
+import hashlib
+import threading
+from types import SimpleNamespace
+import time
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 # from app.services.openai_service import generate_response
 import re
+from collections import deque
 
 # Import AI services - Conditionally import or comment out unused ones
 # For Gemini-only demo:
 from app.services import gemini_service
+from app.utils.response_cache import SemanticCache
 # try:
 #     from app.services import openai_service
 #     OPENAI_SERVICE_AVAILABLE = True
@@ -29,70 +39,237 @@ from app.services import gemini_service
 
 load_dotenv()
 
+# One client for all Graph API calls, shared by every request on the event loop, so TLS
+# connections to graph.facebook.com are kept alive (and multiplexed over HTTP/2) instead of
+# being re-established for every message. Its single SSL context is built once with the client.
+# TCP_NODELAY sends small message POSTs without waiting to coalesce them, and failed connection
+# attempts (never sent requests) are retried. Closed by close_http_client() on shutdown.
+_client = httpx.AsyncClient(
+    headers={"Content-type": "application/json"},
+    timeout=httpx.Timeout(10.0, connect=3.0),
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        socket_options=[(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)],
+    ),
+)
+
+
+# Replies to near-duplicate messages from the same user are served from here (when fastembed
+# is installed). Users can put NO_CACHE_MARKER in a message to always get a fresh answer.
+_semantic_cache = SemanticCache()
+NO_CACHE_MARKER = "#nocache"
+# Error and fallback replies must never be reused for later messages.
+_UNCACHEABLE_PREFIXES = ("Error", "Sorry, I couldn't", "AI Provider '")
+# Replies that only hold at the moment they were written (times, dates) or that don't answer.
+_UNCACHEABLE_RE = re.compile(r"\b\d{1,2}:\d{2}\b|\b\d{4}-\d{2}-\d{2}\b|\bI don'?t know\b", re.IGNORECASE)
+
+# Exact repeats ("hi", "menu", "help") are answered from here before paying for an embedding.
+# Keyed by (wa_id, conversation context, normalized message), so "yes" or "tell me more" only
+# reuses a reply given at the same point in the conversation.
+_exact_cache = TTLCache(maxsize=4096, ttl=300)
+_exact_cache_lock = threading.Lock()
+
+# Replies being generated at once across all message workers, to stay within the AI provider's rate limits.
+AI_CONCURRENCY = 8
+_ai_semaphore = asyncio.Semaphore(AI_CONCURRENCY)
+
+# Incoming messages are queued and answered by MESSAGE_WORKERS background tasks, so the webhook
+# is acknowledged without waiting for the AI provider (Meta retries slow webhooks).
+MESSAGE_WORKERS = 32
+MESSAGE_QUEUE_SIZE = 10_000  # Across all users
+MESSAGE_DRAIN_SECONDS = 10
+_user_queues = {}  # wa_id -> deque of that user's unanswered messages, while queued or being answered
+_ready_users = None  # asyncio.Queue of wa_ids waiting for a worker, created on startup
+_queued_messages = 0
+_message_workers = []
+
+# Streamed replies are sent in parts of at least STREAM_FLUSH_CHARS characters, or of at least
+# STREAM_MIN_CHARS once STREAM_FLUSH_SECONDS have passed since the previous part.
+STREAM_FLUSH_CHARS = 600
+STREAM_MIN_CHARS = 150
+STREAM_FLUSH_SECONDS = 0.4
+
+# The parts of an outgoing text message that are the same for every message.
+_MESSAGE_TEMPLATE = {"messaging_product": "whatsapp", "recipient_type": "individual", "type": "text"}
+
+# Graph API settings, set by init_whatsapp() when the app is created.
+_CFG = None
+
+# Error results of send_message, built once since they never change (and can pile up during an outage).
+_TIMEOUT_RESPONSE = (
+    Response(orjson.dumps({"status": "error", "message": "Request timed out"}), status=408, mimetype="application/json"),
+    408,
+)
+_SEND_FAILED_RESPONSE = (
+    Response(orjson.dumps({"status": "error", "message": "Failed to send message"}), status=500, mimetype="application/json"),
+    500,
+)
+
+# Compiled once instead of being looked up in re's pattern cache for every message. Matches
+# 【citations】 (group 1 unset) and **bold** spans (group 1 is the text) in a single pass.
+_FORMATTING_RE = re.compile(r"【.*?】|\*\*(.*?)\*\*")
+_CITATION_RE = re.compile(r"【.*?】")
+
+
+async def load_semantic_cache_model():
+    """Loads the semantic cache's embedding model at startup rather than on the first message."""
+    if not _semantic_cache.enabled:
+        return
+    try:
+        await asyncio.to_thread(_semantic_cache.load_model)
+    except Exception as e:
+        logging.error(f"Failed to load the semantic cache model, will retry when a message needs it: {e}")
+
+
+async def close_http_client():
+    await _client.aclose()
+    # if DEEPSEEK_SERVICE_AVAILABLE:
+    #     await deepseek_service.close_http_client()
+
 
 def log_http_response(response):
-    logging.info(f"Status: {response.status_code}")
-    logging.info(f"Content-type: {response.headers.get('content-type')}")
-    logging.info(f"Body: {response.text}")
+    # Called for every message sent, so the arguments are only formatted if the record is emitted.
+    logging.info("Status: %s", response.status_code)
+    logging.info("Content-type: %s", response.headers.get("content-type"))
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Body: %s", response.text)
 
 
 def get_text_message_input(recipient, text):
-    return json.dumps(
-        {
-            "messaging_product": "whatsapp",
-            "recipient_type": "individual",
-            "to": recipient,
-            "type": "text",
-            "text": {"preview_url": False, "body": text},
-        }
+    # orjson returns bytes, which httpx sends as the request body without re-encoding.
+    return orjson.dumps({**_MESSAGE_TEMPLATE, "to": recipient, "text": {"preview_url": False, "body": text}})
+
+
+@functools.lru_cache(maxsize=1)
+def _provider() -> str:
+    # The environment doesn't change while the process runs, so this is resolved once.
+    return os.getenv("AI_PROVIDER", "gemini").lower() # Default to gemini for demo
+
+
+async def generate_response_stream(message_body: str, wa_id: str, name: str):
+    """
+    Yields the reply to message_body in pieces as the AI provider generates it.
+    A cached reply is yielded as a single piece.
+    """
+    use_cache = NO_CACHE_MARKER not in message_body
+    message_body = message_body.replace(NO_CACHE_MARKER, "").strip()
+    context = _conversation_context(wa_id) if use_cache else None
+    exact_key = (wa_id, context, message_body.lower())
+
+    if use_cache:
+        with _exact_cache_lock:
+            cached_response = _exact_cache.get(exact_key)
+        if cached_response is not None:
+            logging.info(f"Exact-match cache hit for {wa_id}")
+            _record_cached_turn(wa_id, message_body, cached_response)
+            yield cached_response
+            return
+
+    embedding = cached_response = None
+    if use_cache and _semantic_cache.enabled:
+        # Embedding runs a (small) model, so keep it off the event loop. The cache is only an
+        # optimization: if it fails (model unavailable, database locked), ask the AI provider.
+        try:
+            embedding = await asyncio.to_thread(_semantic_cache.embed, message_body)
+            cached_response = await asyncio.to_thread(_semantic_cache.lookup, wa_id, context, embedding)
+        except Exception as e:
+            logging.error(f"Semantic cache lookup failed for {wa_id}: {e}")
+        if cached_response is not None:
+            _remember_exact(exact_key, cached_response)
+            _record_cached_turn(wa_id, message_body, cached_response)
+            yield cached_response
+            return
+
+    response_parts = []
+    async for chunk in _generate_ai_response_stream(message_body, wa_id, name):
+        # An error can follow partial output, so every piece is checked before caching.
+        use_cache = use_cache and not chunk.startswith(_UNCACHEABLE_PREFIXES)
+        response_parts.append(chunk)
+        yield chunk
+    response_text = "".join(response_parts)
+
+    if use_cache and _is_cacheable(response_text):
+        _remember_exact(exact_key, response_text)
+        if embedding is not None:
+            try:
+                await asyncio.to_thread(_semantic_cache.store, wa_id, context, embedding, message_body, response_text)
+            except Exception as e:
+                logging.error(f"Failed to store reply in the semantic cache for {wa_id}: {e}")
+
+
+def _conversation_context(wa_id: str) -> str:
+    """Identifies where the conversation with wa_id is: a hash of the last reply ("" if none)."""
+    last_reply = gemini_service.last_gemini_reply(wa_id)
+    return hashlib.sha256(last_reply.encode("utf-8")).hexdigest() if last_reply else ""
+
+
+def _record_cached_turn(wa_id: str, message_body: str, response_text: str):
+    # A reply served from a cache is still part of the conversation the provider sees next time.
+    gemini_service.append_gemini_turns(wa_id, [
+        {"role": "user", "parts": [message_body]},
+        {"role": "model", "parts": [response_text]},
+    ])
+
+
+def _remember_exact(key: tuple, response_text: str):
+    with _exact_cache_lock:
+        _exact_cache[key] = response_text
+
+
+def _is_cacheable(response_text: str) -> bool:
+    return (
+        bool(response_text)
+        and not response_text.startswith(_UNCACHEABLE_PREFIXES)
+        and not _UNCACHEABLE_RE.search(response_text)
     )
 
 
-def generate_response(message_body: str, wa_id: str, name: str) -> str:
-    ai_provider = os.getenv("AI_PROVIDER", "gemini").lower() # Default to gemini for demo
-    response_text = f"Sorry, I couldn't process your request using {ai_provider}."
+async def _generate_ai_response_stream(message_body: str, wa_id: str, name: str):
+    ai_provider = _provider()
 
     logging.info(f"Using AI provider: {ai_provider} for user {name} ({wa_id})")
 
     if ai_provider == "gemini":
-        response_text = gemini_service.generate_ai_response(message_body, wa_id, name)
+        async for chunk in gemini_service.generate_ai_response_stream(message_body, wa_id, name):
+            yield chunk
     # elif ai_provider == "openai" and OPENAI_SERVICE_AVAILABLE:
-    #     response_text = openai_service.generate_response(message_body, wa_id, name)
+    #     yield openai_service.generate_response(message_body, wa_id, name)
     # elif ai_provider == "deepseek" and DEEPSEEK_SERVICE_AVAILABLE:
-    #     response_text = deepseek_service.generate_ai_response(message_body, wa_id, name)
+    #     yield await deepseek_service.generate_ai_response(message_body, wa_id, name)
     elif ai_provider == "openai" or ai_provider == "deepseek":
         logging.warning(f"AI Provider '{ai_provider}' is configured but its service module might be commented out or unavailable for this demo.")
-        response_text = f"AI Provider '{ai_provider}' is not available in this demo configuration."
+        yield f"AI Provider '{ai_provider}' is not available in this demo configuration."
     else:
         logging.warning(f"Invalid AI_PROVIDER: {ai_provider}. Defaulting to Gemini for this demo or error.")
         # Fallback to Gemini if provider is misconfigured for demo
-        response_text = gemini_service.generate_ai_response(message_body, wa_id, name) 
-        # response_text = f"AI Provider '{'''{ai_provider}'''}' is not configured. Echo: {message_body}"
+        async for chunk in gemini_service.generate_ai_response_stream(message_body, wa_id, name):
+            yield chunk
+        # yield f"AI Provider '{'''{ai_provider}'''}' is not configured. Echo: {message_body}"
 
-    return response_text
 
+def init_whatsapp(app):
+    """Binds the Graph API settings from app.config, which send_message uses for every message."""
+    global _CFG
+    _CFG = SimpleNamespace(
+        messages_url=f"https://graph.facebook.com/{app.config['VERSION']}/{app.config['PHONE_NUMBER_ID']}/messages",
+        auth_headers={"Authorization": f"Bearer {app.config['ACCESS_TOKEN']}"},
+    )
 
-def send_message(data):
-    headers = {
-        "Content-type": "application/json",
-        "Authorization": f"Bearer {current_app.config['ACCESS_TOKEN']}",
-    }
-
-    url = f"https://graph.facebook.com/{current_app.config['VERSION']}/{current_app.config['PHONE_NUMBER_ID']}/messages"
 
+async def send_message(data):
     try:
-        response = requests.post(
-            url, data=data, headers=headers, timeout=10
-        )  # 10 seconds timeout as an example
-        response.raise_for_status()  # Raises an HTTPError if the HTTP request returned an unsuccessful status code
-    except requests.Timeout:
+        response = await _client.post(_CFG.messages_url, content=data, headers=_CFG.auth_headers)
+        response.raise_for_status()  # Raises an HTTPStatusError if the HTTP request returned an unsuccessful status code
+    except httpx.TimeoutException:
         logging.error("Timeout occurred while sending message")
-        return jsonify({"status": "error", "message": "Request timed out"}), 408
+        return _TIMEOUT_RESPONSE
     except (
-        requests.RequestException
+        httpx.HTTPError
     ) as e:  # This will catch any general request exception
         logging.error(f"Request failed due to: {e}")
-        return jsonify({"status": "error", "message": "Failed to send message"}), 500
+        return _SEND_FAILED_RESPONSE
     else:
         # Process the response as normal
         log_http_response(response)
@@ -100,51 +277,168 @@ def send_message(data):
 
 
 def process_text_for_whatsapp(text):
-    # Remove brackets
-    pattern = r"\【.*?\】"
-    # Substitute the pattern with an empty string
-    text = re.sub(pattern, "", text).strip()
+    # Remove brackets, and replace double asterisks (including the word(s) in between) with
+    # single asterisks, in one scan of the text
+    return _FORMATTING_RE.sub(_format_for_whatsapp, text).strip()
 
-    # Pattern to find double asterisks including the word(s) in between
-    pattern = r"\*\*(.*?)\*\*"
 
-    # Replacement pattern with single asterisks
-    replacement = r"*\1*"
+def _format_for_whatsapp(match):
+    bold_text = match.group(1)
+    if bold_text is None:
+        return ""
+    if "【" in bold_text:
+        # A citation inside a bold span is removed too
+        bold_text = _CITATION_RE.sub("", bold_text)
+    return f"*{bold_text}*"
 
-    # Substitute occurrences of the pattern with the replacement
-    whatsapp_style_text = re.sub(pattern, replacement, text)
 
-    return whatsapp_style_text
+async def process_whatsapp_message(wa_id, name, message_body):
+    # The reply is sent as it is generated: whenever the buffered text ends in a complete
+    # paragraph or sentence and is long enough (or has waited long enough), that part goes out
+    # as its own WhatsApp message while the rest is still being generated.
+    buffer = ""
+    last_flush = time.monotonic()
+    previous_send = None
 
+    # At most AI_CONCURRENCY replies are being generated at once, to stay within rate limits.
+    async with _ai_semaphore:
+        # TODO: implement custom function here
+        async for chunk in generate_response_stream(message_body, wa_id, name):
+            buffer += chunk
+            waited = time.monotonic() - last_flush >= STREAM_FLUSH_SECONDS
+            if len(buffer) < (STREAM_MIN_CHARS if waited else STREAM_FLUSH_CHARS):
+                continue
+            split = _complete_prefix_length(buffer)
+            if split:
+                previous_send = _send_text(wa_id, buffer[:split], previous_send)
+                buffer = buffer[split:]
+                last_flush = time.monotonic()
 
-def process_whatsapp_message(body):
-    wa_id = body["entry"][0]["changes"][0]["value"]["contacts"][0]["wa_id"]
-    name = body["entry"][0]["changes"][0]["value"]["contacts"][0]["profile"]["name"]
+    if buffer.strip():
+        previous_send = _send_text(wa_id, buffer, previous_send)
+    if previous_send is not None:
+        await previous_send
 
-    message = body["entry"][0]["changes"][0]["value"]["messages"][0]
-    message_body = message["text"]["body"]
 
-    # TODO: implement custom function here
-    response = generate_response(message_body, wa_id, name)
+def _send_text(wa_id, text, previous_send):
+    """Sends text to wa_id once previous_send (if any) is done, so messages arrive in order."""
+    # Formatting is applied per message, on text that never splits a **bold** span.
+    data = get_text_message_input(wa_id, process_text_for_whatsapp(text))
 
-    # OpenAI Integration
-    # response = generate_response(message_body, wa_id, name)
-    response = process_text_for_whatsapp(response)
+    async def send():
+        if previous_send is not None:
+            await previous_send
+        await send_message(data)
 
-    #data = get_text_message_input(current_app.config["RECIPIENT_WAID"], response)
-    data = get_text_message_input(wa_id, response)
-    send_message(data)
+    return asyncio.create_task(send())
 
 
-def is_valid_whatsapp_message(body):
+def _complete_prefix_length(text):
     """
-    Check if the incoming webhook event has a valid WhatsApp message structure.
+    Returns the length of the longest prefix of text that ends at a line break (or else at the
+    end of a sentence) without leaving a **bold** span or 【】 citation open, or 0 if none does.
     """
-    return (
-        body.get("object")
-        and body.get("entry")
-        and body["entry"][0].get("changes")
-        and body["entry"][0]["changes"][0].get("value")
-        and body["entry"][0]["changes"][0]["value"].get("messages")
-        and body["entry"][0]["changes"][0]["value"]["messages"][0]
-    )
+    for boundary in ("\n", ". ", "! ", "? "):
+        index = text.rfind(boundary)
+        while index != -1:
+            end = index + len(boundary)
+            head = text[:end]
+            if head.count("**") % 2 == 0 and head.count("【") == head.count("】"):
+                return end
+            index = text.rfind(boundary, 0, index)
+    return 0
+
+
+def enqueue_whatsapp_messages(messages):
+    """
+    Queues every (wa_id, name, message_body) in messages to be answered by the message workers,
+    so the webhook can be acknowledged right away. Messages beyond MESSAGE_QUEUE_SIZE are dropped.
+
+    Each user has their own queue, which one worker at a time drains, so a user's messages are
+    answered in order (each reply sees the history of the one before it) while a slow reply for
+    one user never holds up anyone else's.
+    """
+    global _queued_messages
+    for message in messages:
+        wa_id = message[0]
+        if _queued_messages >= MESSAGE_QUEUE_SIZE:
+            logging.warning(f"Message queue is full, dropping message from {wa_id}")
+            continue
+        user_queue = _user_queues.get(wa_id)
+        if user_queue is None:
+            # Not queued or being answered right now, so hand the user to the next free worker.
+            user_queue = _user_queues[wa_id] = deque()
+            _ready_users.put_nowait(wa_id)
+        user_queue.append(message)
+        _queued_messages += 1
+
+
+async def start_message_workers():
+    global _ready_users
+    _ready_users = asyncio.Queue()
+    for _ in range(MESSAGE_WORKERS):
+        _message_workers.append(asyncio.create_task(_message_worker()))
+
+
+async def stop_message_workers():
+    # Give queued messages a chance to be answered before shutting down.
+    try:
+        await asyncio.wait_for(_ready_users.join(), MESSAGE_DRAIN_SECONDS)
+    except asyncio.TimeoutError:
+        logging.warning(f"Shutting down with {_queued_messages} unanswered messages still queued")
+    for worker in _message_workers:
+        worker.cancel()
+    await asyncio.gather(*_message_workers, return_exceptions=True)
+    _message_workers.clear()
+
+
+async def _message_worker():
+    global _queued_messages
+    while True:
+        wa_id = await _ready_users.get()
+        user_queue = _user_queues[wa_id]
+        try:
+            while user_queue:
+                _, name, message_body = user_queue.popleft()
+                _queued_messages -= 1
+                try:
+                    await process_whatsapp_message(wa_id, name, message_body)
+                except Exception as e:
+                    logging.error(f"Failed to process WhatsApp message from {wa_id}: {e}")
+        finally:
+            # Nothing awaits between the empty check and this, so no message can be left behind.
+            _queued_messages -= len(user_queue)
+            del _user_queues[wa_id]
+            _ready_users.task_done()
+
+
+def get_webhook_value(body):
+    """Returns the entry[0].changes[0].value of a webhook event, or None if it has none."""
+    try:
+        return body["entry"][0]["changes"][0]["value"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def extract_whatsapp_messages(value):
+    """
+    Returns a (wa_id, name, message_body) tuple for each text message in the value of an
+    incoming webhook event (see get_webhook_value). The list is empty if the value doesn't
+    have that structure.
+    """
+    try:
+        names = {contact["wa_id"]: contact["profile"]["name"] for contact in value["contacts"]}
+        default_wa_id = value["contacts"][0]["wa_id"]
+        messages = value["messages"]
+    except (KeyError, IndexError, TypeError):
+        return []
+
+    extracted = []
+    for message in messages:
+        try:
+            wa_id = message.get("from", default_wa_id)
+            extracted.append((wa_id, names.get(wa_id, names[default_wa_id]), message["text"]["body"]))
+        except (KeyError, TypeError, AttributeError):
+            continue  # Not a text message (image, reaction, ...)
+    return extracted
+
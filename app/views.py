@@ -1,18 +1,19 @@
 import logging
-import json
+import orjson
 
-from flask import Blueprint, request, jsonify, current_app
+from quart import Blueprint, request, jsonify, current_app
 
 from .decorators.security import signature_required
 from .utils.whatsapp_utils import (
-    process_whatsapp_message,
-    is_valid_whatsapp_message,
+    enqueue_whatsapp_messages,
+    get_webhook_value,
+    extract_whatsapp_messages,
 )
 
 webhook_blueprint = Blueprint("webhook", __name__)
 
 
-def handle_message():
+async def handle_message():
     """
     Handle incoming webhook events from the WhatsApp API.
 
@@ -26,32 +27,38 @@ def handle_message():
     Returns:
         response: A tuple containing a JSON response and an HTTP status code.
     """
-    body = request.get_json()
+    try:
+        body = orjson.loads(await request.get_data())
+    except orjson.JSONDecodeError:
+        logging.error("Failed to decode JSON")
+        return jsonify({"status": "error", "message": "Invalid JSON provided"}), 400
     # logging.info(f"request body: {body}")
 
-    # Check if it's a WhatsApp status update
-    if (
-        body.get("entry", [{}])[0]
-        .get("changes", [{}])[0]
-        .get("value", {})
-        .get("statuses")
-    ):
+    # The payload is walked down to the change value once, for both checks below.
+    value = get_webhook_value(body)
+
+    # Check if it's a WhatsApp status update (most webhook events are: sent, delivered, read)
+    if value is not None and value.get("statuses"):
         logging.info("Received a WhatsApp status update.")
         return jsonify({"status": "ok"}), 200
 
-    try:
-        if is_valid_whatsapp_message(body):
-            process_whatsapp_message(body)
-            return jsonify({"status": "ok"}), 200
+    if value is not None and body.get("object") and value.get("messages"):
+        # Pulls out the sender and text of every text message the event carries (WhatsApp may
+        # batch several). Other messages (images, stickers, reactions) are acknowledged too, so
+        # Meta doesn't retry them, but nothing is sent back.
+        messages = extract_whatsapp_messages(value)
+        if messages:
+            # Replies are generated and sent by the message workers; Meta only needs the 200.
+            enqueue_whatsapp_messages(messages)
         else:
-            # if the request is not a WhatsApp API event, return an error
-            return (
-                jsonify({"status": "error", "message": "Not a WhatsApp API event"}),
-                404,
-            )
-    except json.JSONDecodeError:
-        logging.error("Failed to decode JSON")
-        return jsonify({"status": "error", "message": "Invalid JSON provided"}), 400
+            logging.info("Received a WhatsApp message without text, nothing to answer.")
+        return jsonify({"status": "ok"}), 200
+    else:
+        # if the request is not a WhatsApp API event, return an error
+        return (
+            jsonify({"status": "error", "message": "Not a WhatsApp API event"}),
+            404,
+        )
 
 
 # Required webhook verifictaion for WhatsApp
@@ -83,7 +90,7 @@ def webhook_get():
 
 @webhook_blueprint.route("/webhook", methods=["POST"])
 @signature_required
-def webhook_post():
-    return handle_message()
+async def webhook_post():
+    return await handle_message()
 
 
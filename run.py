@@ -1,10 +1,27 @@
+import asyncio
 import logging
 
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+
 from app import create_app
 
+# Try to use uvloop for a faster event loop, but don't make it a hard requirement (it doesn't support Windows)
+try:
+    import uvloop
+    UVLOOP_AVAILABLE = True
+except ImportError:
+    UVLOOP_AVAILABLE = False
+
 
 app = create_app()
 
 if __name__ == "__main__":
-    logging.info("Flask app started")
-    app.run(host="0.0.0.0", port=8000)
+    # Served by Hypercorn, an ASGI server, instead of Quart's development server.
+    config = Config()
+    config.bind = ["0.0.0.0:8000"]
+    logging.info(f"Quart app started (event loop: {'uvloop' if UVLOOP_AVAILABLE else 'asyncio'})")
+    if UVLOOP_AVAILABLE:
+        uvloop.run(serve(app, config))
+    else:
+        asyncio.run(serve(app, config))
@@ -0,0 +1,42 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from app.utils.thread_store import ThreadStore
+
+
+class ThreadStoreEvictionTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.store = ThreadStore("turns", path=os.path.join(self._dir.name, "threads.db"), max_cached=2)
+
+    def tearDown(self):
+        self.store.close()
+        self._dir.cleanup()
+
+    def test_append_keeps_new_conversation_cached_while_others_are_unwritten(self):
+        # Hold the writer inside its first batch, so every cached conversation has unwritten changes.
+        release = threading.Event()
+        writing = threading.Event()
+        write = self.store._write
+
+        def slow_write(pending):
+            writing.set()
+            release.wait(5)
+            write(pending)
+
+        self.store._write = slow_write
+        self.store.append("a", [{"role": "user", "content": "a"}])
+        self.assertTrue(writing.wait(5))
+        self.store.append("b", [{"role": "user", "content": "b"}])
+
+        turn = [{"role": "user", "content": "hi"}, {"role": "model", "content": "hello"}]
+        self.store.append("c", turn)
+
+        self.assertEqual(self.store.get("c"), turn)
+        release.set()
+
+
+if __name__ == "__main__":
+    unittest.main()